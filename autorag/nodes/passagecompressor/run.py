@@ -7,7 +7,7 @@ import pandas as pd
 
 from autorag.evaluation.metric import retrieval_token_recall, retrieval_token_precision, retrieval_token_f1
 from autorag.strategy import measure_speed, filter_by_threshold, select_best
-from autorag.utils.util import fetch_contents
+from autorag.utils.util import fetch_contents, reconstruct_list
 
 
 def run_passage_compressor_node(modules: List[Callable],
@@ -52,7 +52,10 @@ def run_passage_compressor_node(modules: List[Callable],
     results = list(results)
     average_times = list(map(lambda x: x / len(results[0]), execution_times))
 
-    retrieval_contents_gt = list(map(lambda x: fetch_contents(corpus_data, x), qa_data['retrieval_gt'].tolist()))
+    # fetch all retrieval gt contents at once, then regroup them by QA row
+    retrieval_gt = qa_data['retrieval_gt'].tolist()
+    retrieval_contents_gt = fetch_contents(corpus_data, list(itertools.chain.from_iterable(retrieval_gt)))
+    retrieval_contents_gt = reconstruct_list(retrieval_contents_gt, list(map(len, retrieval_gt)))
     retrieval_contents_gt = list(map(lambda x: list(itertools.chain.from_iterable(x)), retrieval_contents_gt))
 
     # run metrics before filtering
@@ -114,7 +114,7 @@ def run_prompt_maker_node(modules: List[Callable],
                                                                generation_gt * len(results),
                                                                general_strategy['metrics'], project_dir,
                                                                strategy_name=strategies.get('strategy', 'mean'))
-        evaluation_results = split_dataframe(evaluation_result_all, chunk_size=len(results[0]))
+        evaluation_results = list(split_dataframe(evaluation_result_all, chunk_size=len(results[0])))
 
         evaluation_df = pd.DataFrame({
             'filename': filenames,
@@ -2,14 +2,14 @@ import ast
 import asyncio
 import datetime
 import functools
-import glob
 import itertools
 import logging
+import operator
 import os
 import re
 import string
 from copy import deepcopy
-from typing import List, Callable, Dict, Optional, Any, Collection, Iterable
+from typing import List, Callable, Dict, Optional, Any, Collection, Iterable, Iterator, Tuple
 
 import numpy as np
 import pandas as pd
@@ -22,14 +22,28 @@ from tqdm import tqdm
 
 logger = logging.getLogger("AutoRAG")
 
+_PUNCT_TABLE = str.maketrans('', '', string.punctuation)
+_ARTICLES_RE = re.compile(r"\b(a|an|the)\b")
+_ENV_RE = re.compile(r"\$\{([^}]*)\}")
+
 
 def fetch_contents(corpus_data: pd.DataFrame, ids: List[List[str]],
                    column_name: str = 'contents') -> List[List[Any]]:
-    def fetch_contents_pure(ids: List[str], corpus_data: pd.DataFrame, column_name: str):
-        return list(map(lambda x: fetch_one_content(corpus_data, x, column_name), ids))
+    # Narrow the corpus to the requested ids before building the lookup,
+    # keeping the first row of duplicated doc_ids.
+    requested_ids = list({id_ for id_list in ids for id_ in id_list if isinstance(id_, str) and id_ != ''})
+    requested_df = corpus_data.loc[corpus_data['doc_id'].isin(requested_ids), ['doc_id', column_name]]
+    requested_df = requested_df.drop_duplicates(subset='doc_id')
+    lookup = dict(zip(requested_df['doc_id'], requested_df[column_name]))
+
+    def fetch_one(id_: str) -> Any:
+        if not isinstance(id_, str) or id_ == '':
+            return None
+        if id_ not in lookup:
+            raise ValueError(f"doc_id: {id_} not found in corpus_data.")
+        return lookup[id_]
 
-    result = flatten_apply(fetch_contents_pure, ids, corpus_data=corpus_data, column_name=column_name)
-    return result
+    return [list(map(fetch_one, id_list)) if len(id_list) > 0 else [None] for id_list in ids]
 
 
 def fetch_one_content(corpus_data: pd.DataFrame, id_: str,
@@ -80,7 +94,9 @@ def load_summary_file(summary_path: str,
     """
     if not os.path.exists(summary_path):
         raise ValueError(f"summary.csv does not exist in {summary_path}.")
-    summary_df = pd.read_csv(summary_path)
+    stat = os.stat(summary_path)
+    file_key = (stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+    summary_df = _read_summary_csv(summary_path, file_key).copy()
     if dict_columns is None:
         dict_columns = ['module_params']
 
@@ -97,10 +113,21 @@ def load_summary_file(summary_path: str,
                 raise ValueError(f"Malformed dict received : {elem}\nCan't convert to dict properly")
             return {'threshold': date_object}
 
-    summary_df[dict_columns] = summary_df[dict_columns].applymap(convert_dict)
+    # Many rows share the same dict string, so parse each unique string only once.
+    # Each row still gets its own copy, so mutating one row does not change the others.
+    for col in dict_columns:
+        mapping = {elem: convert_dict(elem) for elem in summary_df[col].drop_duplicates()}
+        summary_df[col] = [deepcopy(mapping[elem]) for elem in summary_df[col]]
     return summary_df
 
 
+@functools.lru_cache(maxsize=32)
+def _read_summary_csv(summary_path: str, file_key: Tuple[int, int, int, int]) -> pd.DataFrame:
+    # file_key is (inode, size, mtime_ns, ctime_ns), so a rewritten summary file is read again
+    # even when it is rewritten within one mtime tick, unless it keeps the same inode and size.
+    return pd.read_csv(summary_path)
+
+
 def convert_datetime_string(s):
     # Regex to extract datetime arguments from the string
     m = re.search(r"(datetime|date)(\((\d+)(,\s*\d+)*\))", s)
@@ -140,11 +167,12 @@ def make_combinations(target_dict: Dict[str, Any]) -> List[Dict[str, Any]]:
             # TODO: add duplication check for unhashable objects
             return x
         else:
-            return list(set(x))
+            # dict.fromkeys keeps the first-seen order, so combinations are reproducible
+            return list(dict.fromkeys(x))
 
     dict_with_lists = dict(map(lambda x: (x[0], delete_duplicate(x[1])), dict_with_lists.items()))
-    combination = list(itertools.product(*dict_with_lists.values()))
-    combination_dicts = [dict(zip(dict_with_lists.keys(), combo)) for combo in combination]
+    keys = list(dict_with_lists.keys())
+    combination_dicts = [dict(zip(keys, combo)) for combo in itertools.product(*dict_with_lists.values())]
     return combination_dicts
 
 
@@ -159,30 +187,28 @@ def explode(index_values: Collection[Any], explode_values: Collection[Collection
     :return: Tuple of exploded index_values and exploded explode_values.
     """
     assert len(index_values) == len(explode_values), "Index values and explode values must have same length"
-    df = pd.DataFrame({
-        'index_values': index_values,
-        'explode_values': explode_values
-    })
-    df = df.explode('explode_values')
-    return df['index_values'].tolist(), df['explode_values'].tolist()
+    exploded_index = list(itertools.chain.from_iterable(
+        itertools.repeat(index, len(values)) for index, values in zip(index_values, explode_values)))
+    exploded_values = list(itertools.chain.from_iterable(explode_values))
+    return exploded_index, exploded_values
 
 
 def replace_value_in_dict(target_dict: Dict, key: str,
                           replace_value: Any) -> Dict:
     """
     Replace the value of the certain key in target_dict.
-    If there is not targeted key in target_dict, it will return target_dict.
+    If there is not targeted key in target_dict, it will return a copy of target_dict.
+    The returned dictionary is a shallow copy,
+    so deepcopy target_dict yourself if you need to mutate its nested values.
 
     :param target_dict: The target dictionary.
     :param key: The key to replace.
     :param replace_value: The value to replace.
     :return: The replaced dictionary.
     """
-    replaced_dict = deepcopy(target_dict)
-    if key not in replaced_dict:
-        return replaced_dict
-    replaced_dict[key] = replace_value
-    return replaced_dict
+    if key not in target_dict:
+        return dict(target_dict)
+    return {**target_dict, key: replace_value}
 
 
 def normalize_string(s: str) -> str:
@@ -192,14 +218,13 @@ def normalize_string(s: str) -> str:
     """
 
     def remove_articles(text):
-        return re.sub(r"\b(a|an|the)\b", " ", text)
+        return _ARTICLES_RE.sub(" ", text)
 
     def white_space_fix(text):
         return " ".join(text.split())
 
     def remove_punc(text):
-        exclude = set(string.punctuation)
-        return "".join(ch for ch in text if ch not in exclude)
+        return text.translate(_PUNCT_TABLE)
 
     def lower(text):
         return text.lower()
@@ -209,26 +234,34 @@ def normalize_string(s: str) -> str:
 
 def convert_string_to_tuple_in_dict(d):
     """Recursively converts strings that start with '(' and end with ')' to tuples in a dictionary."""
-    for key, value in d.items():
-        # If the value is a dictionary, recurse
-        if isinstance(value, dict):
-            convert_string_to_tuple_in_dict(value)
-        # If the value is a list, iterate through its elements
-        elif isinstance(value, list):
-            for i, item in enumerate(value):
-                # If an item in the list is a dictionary, recurse
-                if isinstance(item, dict):
-                    convert_string_to_tuple_in_dict(item)
-                # If an item in the list is a string matching the criteria, convert it to a tuple
-                elif isinstance(item, str) and item.startswith('(') and item.endswith(')'):
-                    value[i] = ast.literal_eval(item)
-        # If the value is a string matching the criteria, convert it to a tuple
-        elif isinstance(value, str) and value.startswith('(') and value.endswith(')'):
-            d[key] = ast.literal_eval(value)
+    stack = [d]
+    while stack:
+        current = stack.pop()
+        for key, value in current.items():
+            # If the value is a dictionary, visit it later
+            if isinstance(value, dict):
+                stack.append(value)
+            # If the value is a list, iterate through its elements
+            elif isinstance(value, list):
+                for i, item in enumerate(value):
+                    if isinstance(item, dict):
+                        stack.append(item)
+                    # If an item in the list is a string matching the criteria, convert it to a tuple
+                    elif isinstance(item, str) and item.startswith('(') and item.endswith(')'):
+                        value[i] = _literal_eval_cached(item)
+            # If the value is a string matching the criteria, convert it to a tuple
+            elif isinstance(value, str) and value.startswith('(') and value.endswith(')'):
+                current[key] = _literal_eval_cached(value)
 
     return d
 
 
+@functools.lru_cache(maxsize=4096)
+def _literal_eval_cached(s: str) -> Any:
+    # The same tuple strings repeat across many config combinations
+    return ast.literal_eval(s)
+
+
 def convert_env_in_dict(d: Dict):
     """
     Recursively converts environment variable string in a dictionary to actual environment variable.
@@ -236,45 +269,51 @@ def convert_env_in_dict(d: Dict):
     :param d: The dictionary to convert.
     :return: The converted dictionary.
     """
-    env_pattern = re.compile(r".*?\${(.*?)}.*?")
 
     def convert_env(val: str):
-        matches = env_pattern.findall(val)
-        for match in matches:
-            val = val.replace(f"${{{match}}}", os.environ.get(match, ""))
-        return val
-
-    for key, value in d.items():
-        if isinstance(value, dict):
-            convert_env_in_dict(value)
-        elif isinstance(value, list):
-            for i, item in enumerate(value):
-                if isinstance(item, dict):
-                    convert_env_in_dict(item)
-                elif isinstance(item, str):
-                    value[i] = convert_env(item)
-        elif isinstance(value, str):
-            d[key] = convert_env(value)
+        return _ENV_RE.sub(lambda m: os.environ.get(m.group(1), ""), val)
+
+    stack = [d]
+    while stack:
+        current = stack.pop()
+        for key, value in current.items():
+            if isinstance(value, dict):
+                stack.append(value)
+            elif isinstance(value, list):
+                for i, item in enumerate(value):
+                    if isinstance(item, dict):
+                        stack.append(item)
+                    elif isinstance(item, str):
+                        value[i] = convert_env(item)
+            elif isinstance(value, str):
+                current[key] = convert_env(value)
     return d
 
 
 async def process_batch(tasks, batch_size: int = 64) -> List[Any]:
     """
-    Processes tasks in batches asynchronously.
+    Processes tasks asynchronously, keeping at most batch_size tasks in flight.
+    A new task starts as soon as a running one finishes,
+    so a slow task does not hold back the rest of the tasks.
 
     :param tasks: A list of no-argument functions or coroutines to be executed.
-    :param batch_size: The number of tasks to process in a single batch.
+    :param batch_size: The maximum number of tasks to run concurrently.
         Default is 64.
-    :return: A list of results from the processed tasks.
+    :return: A list of results from the processed tasks, in the same order as tasks.
     """
-    results = []
+    semaphore = asyncio.Semaphore(batch_size)
+    progress_bar = tqdm(total=len(tasks))
 
-    for i in tqdm(range(0, len(tasks), batch_size)):
-        batch = tasks[i:i + batch_size]
-        batch_results = await asyncio.gather(*batch)
-        results.extend(batch_results)
+    async def run(task):
+        async with semaphore:
+            result = await task
+        progress_bar.update(1)
+        return result
 
-    return results
+    try:
+        return await asyncio.gather(*(run(task) for task in tasks))
+    finally:
+        progress_bar.close()
 
 
 def make_batch(elems: List[Any], batch_size: int) -> List[List[Any]]:
@@ -295,30 +334,34 @@ def save_parquet_safe(df: pd.DataFrame, filepath: str,
         raise FileExistsError(f"file {filepath} already exists."
                               "Set upsert True if you want to overwrite the file.")
 
-    df.to_parquet(filepath, index=False)
+    df.to_parquet(filepath, index=False, engine='pyarrow', compression='zstd', compression_level=3)
+
+
+@functools.lru_cache(maxsize=16)
+def _get_tiktoken_encoding(model_name: str) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(model_name)
 
 
 def openai_truncate_by_token(texts: List[str], token_limit: int,
                              model_name: str) -> List[str]:
-    tokenizer = tiktoken.encoding_for_model(model_name)
+    truncated_texts, _ = _openai_truncate_and_count(texts, token_limit, model_name)
+    return truncated_texts
 
-    def truncate_text(text: str, limit: int, tokenizer):
-        tokens = tokenizer.encode(text)
-        if len(tokens) <= limit:
-            return text
-        truncated_text = tokenizer.decode(tokens[:limit])
-        return truncated_text
 
-    return list(map(lambda x: truncate_text(x, token_limit, tokenizer), texts))
+def _openai_truncate_and_count(texts: List[str], token_limit: int,
+                               model_name: str) -> Tuple[List[str], List[int]]:
+    tokenizer = _get_tiktoken_encoding(model_name)
+    token_lists = tokenizer.encode_ordinary_batch(texts)
+    truncated_texts = [tokenizer.decode(tokens[:token_limit]) if len(tokens) > token_limit else text
+                       for text, tokens in zip(texts, token_lists)]
+    token_counts = [min(len(tokens), token_limit) for tokens in token_lists]
+    return truncated_texts, token_counts
 
 
 def reconstruct_list(flat_list: List[Any], lengths: List[int]) -> List[List[Any]]:
-    result = []
-    start = 0
-    for length in lengths:
-        result.append(flat_list[start:start + length])
-        start += length
-    return result
+    # Slicing only copies references, so this stays cheap even for large embedding lists.
+    ends = itertools.accumulate(lengths)
+    return [flat_list[end - length:end] for length, end in zip(lengths, ends)]
 
 
 def flatten_apply(func: Callable, nested_list: List[List[Any]], **kwargs) -> List[List[Any]]:
@@ -331,10 +374,10 @@ def flatten_apply(func: Callable, nested_list: List[List[Any]], **kwargs) -> Lis
     :param nested_list: The nested list to be flattened.
     :return: The list that is reconstructed after applying the function.
     """
-    df = pd.DataFrame({'col1': nested_list})
-    df = df.explode('col1')
-    df['result'] = func(df['col1'].tolist(), **kwargs)
-    return df.groupby(level=0, sort=False)['result'].apply(list).tolist()
+    lengths = list(map(len, nested_list))
+    flat_list = list(itertools.chain.from_iterable(nested_list))
+    result = list(func(flat_list, **kwargs))
+    return reconstruct_list(result, lengths)
 
 
 def sort_by_scores(row, reverse=True):
@@ -343,14 +386,21 @@ def sort_by_scores(row, reverse=True):
     The input column names must be 'contents', 'ids', and 'scores'.
     And its elements must be list type.
     """
-    results = sorted(zip(row['contents'], row['ids'], row['scores']), key=lambda x: x[2], reverse=reverse)
+    scores = row['scores']
+    if isinstance(scores, np.ndarray) and scores.dtype.kind in 'fi':
+        # Stable sort keeps the original order of tied scores, same as sorted().
+        order = np.argsort(-scores if reverse else scores, kind='stable')
+        contents, ids = row['contents'], row['ids']
+        return [contents[i] for i in order], [ids[i] for i in order], scores[order].tolist()
+    results = sorted(zip(row['contents'], row['ids'], scores), key=lambda x: x[2], reverse=reverse)
     reranked_contents, reranked_ids, reranked_scores = zip(*results)
     return list(reranked_contents), list(reranked_ids), list(reranked_scores)
 
 
 def select_top_k(df, column_names: List[str], top_k: int):
+    slice_top_k = operator.itemgetter(slice(0, top_k))
     for column_name in column_names:
-        df[column_name] = df[column_name].apply(lambda x: x[:top_k])
+        df[column_name] = list(map(slice_top_k, df[column_name].to_numpy()))
     return df
 
 
@@ -364,35 +414,53 @@ def filter_dict_keys(dict_, keys: List[str]):
     return result
 
 
-def split_dataframe(df, chunk_size):
-    num_chunks = len(df) // chunk_size + 1 if len(df) % chunk_size != 0 else len(df) // chunk_size
-    result = list(map(lambda x: df[x * chunk_size:(x + 1) * chunk_size], range(num_chunks)))
-    result = list(map(lambda x: x.reset_index(drop=True), result))
-    return result
+def split_dataframe(df: pd.DataFrame, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    Lazily split df into chunks of chunk_size rows.
+    Each chunk has its own index starting from 0.
+    Wrap it with list() if you need to go through the chunks more than once.
+    """
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size].reset_index(drop=True)
 
 
 def find_trial_dir(project_dir: str) -> List[str]:
-    # Pattern to match directories named with numbers
-    pattern = os.path.join(project_dir, '[0-9]*')
-    all_entries = glob.glob(pattern)
-
-    # Filter out only directories
-    trial_dirs = [entry for entry in all_entries if os.path.isdir(entry) and entry.split(os.sep)[-1].isdigit()]
-
-    return trial_dirs
+    # Trial directories are named with numbers
+    if not os.path.isdir(project_dir):
+        return []
+    with os.scandir(project_dir) as entries:
+        return [entry.path for entry in entries if entry.name.isdigit() and entry.is_dir()]
 
 
 def find_node_summary_files(trial_dir: str) -> List[str]:
-    # Find all summary.csv files recursively
-    all_summary_files = glob.glob(os.path.join(trial_dir, '**', 'summary.csv'), recursive=True)
+    # Node summary files are at trial_dir/node_line/node/summary.csv or deeper
+    return list(_walk_summary_files(trial_dir, min_depth=2))
 
-    # Filter out files that are at a lower directory level
-    filtered_files = [f for f in all_summary_files if f.count(os.sep) > trial_dir.count(os.sep) + 2]
 
-    return filtered_files
+def _walk_summary_files(root_dir: str, min_depth: int) -> Iterator[str]:
+    """
+    Yield summary.csv paths under root_dir whose directory is at least min_depth levels below root_dir.
+    Hidden entries are skipped, like glob does, and a missing root_dir yields nothing.
+    """
+    if not os.path.isdir(root_dir):
+        return
+    stack = [(root_dir, 0)]
+    while stack:
+        dir_path, depth = stack.pop()
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, depth + 1))
+                elif entry.name == 'summary.csv' and depth >= min_depth:
+                    yield entry.path
 
 
 def normalize_unicode(text: str) -> str:
+    # ASCII text is already in NFC form
+    if text.isascii():
+        return text
     return unicodedata.normalize('NFC', text)
 
 
@@ -439,34 +507,90 @@ def dict_to_markdown_table(data, key_column_name: str, value_column_name: str):
     return markdown_table
 
 
+_OPENAI_MAX_INPUTS_PER_REQUEST = 2048
+_OPENAI_MAX_TOKENS_PER_REQUEST = 290_000  # the API limit is 300k tokens, keep a margin for tokenizer drift
+_OPENAI_MAX_INFLIGHT_REQUESTS = 8
+
+
 def embedding_query_content(queries: List[str], contents_list: List[List[str]],
                             embedding_model: Optional[str] = None, batch: int = 128):
     flatten_contents = list(itertools.chain.from_iterable(contents_list))
 
+    # Embedding using batch
     openai_embedding_limit = 8191  # all openai embedding model has 8191 max token input
     if isinstance(embedding_model, OpenAIEmbedding):
-        queries = openai_truncate_by_token(queries, openai_embedding_limit,
-                                           embedding_model.model_name)
-        flatten_contents = openai_truncate_by_token(flatten_contents, openai_embedding_limit,
-                                                    embedding_model.model_name)
-
-    # Embedding using batch
-    embedding_model.embed_batch_size = batch
-    query_embeddings = embedding_model.get_text_embedding_batch(queries)
+        batch = min(batch, _OPENAI_MAX_INPUTS_PER_REQUEST)
+        embedding_model.embed_batch_size = batch
+        queries, query_token_counts = _openai_truncate_and_count(queries, openai_embedding_limit,
+                                                                 embedding_model.model_name)
+        flatten_contents, content_token_counts = _openai_truncate_and_count(flatten_contents, openai_embedding_limit,
+                                                                            embedding_model.model_name)
+        # Queries and contents do not depend on each other, so embed them concurrently
+        # while sharing one limit on in-flight requests
+        async def embed_queries_and_contents():
+            semaphore = asyncio.Semaphore(_OPENAI_MAX_INFLIGHT_REQUESTS)
+            return await asyncio.gather(
+                _aembed_by_token_budget(embedding_model, queries, query_token_counts, batch, semaphore),
+                _aembed_by_token_budget(embedding_model, flatten_contents, content_token_counts, batch, semaphore),
+            )
+
+        loop = asyncio.get_event_loop()
+        query_embeddings, content_embeddings_flatten = loop.run_until_complete(embed_queries_and_contents())
+    else:
+        # Local embedders are not thread-safe, so embed queries and contents in one batched pass
+        embedding_model.embed_batch_size = batch
+        embeddings = embedding_model.get_text_embedding_batch(list(queries) + flatten_contents)
+        query_embeddings, content_embeddings_flatten = embeddings[:len(queries)], embeddings[len(queries):]
 
     content_lengths = list(map(len, contents_list))
-    content_embeddings_flatten = embedding_model.get_text_embedding_batch(flatten_contents)
     content_embeddings = reconstruct_list(content_embeddings_flatten, content_lengths)
     return query_embeddings, content_embeddings
 
 
+async def _aembed_by_token_budget(embedding_model: OpenAIEmbedding, texts: List[str],
+                                  token_counts: List[int], batch: int,
+                                  semaphore: asyncio.Semaphore) -> List[List[float]]:
+    """
+    Embed texts with one request per packed group, so no request goes over the OpenAI token limit.
+    The embed_batch_size of embedding_model must be at least batch.
+    The semaphore bounds the in-flight requests and can be shared between concurrent calls.
+    """
+    groups = _pack_by_token_budget(token_counts, _OPENAI_MAX_TOKENS_PER_REQUEST, batch)
+
+    async def embed_group(start: int, end: int):
+        async with semaphore:
+            return await embedding_model.aget_text_embedding_batch(texts[start:end])
+
+    results = await asyncio.gather(*(embed_group(start, end) for start, end in groups))
+    return list(itertools.chain.from_iterable(results))
+
+
+def _pack_by_token_budget(token_counts: List[int], max_tokens: int,
+                          max_items: int) -> List[Tuple[int, int]]:
+    """
+    Greedily split consecutive texts into (start, end) groups
+    that have at most max_items texts and max_tokens tokens each.
+    A single text over max_tokens gets its own group.
+    """
+    groups = []
+    start, group_tokens = 0, 0
+    for i, token_count in enumerate(token_counts):
+        if i > start and (group_tokens + token_count > max_tokens or i - start >= max_items):
+            groups.append((start, i))
+            start, group_tokens = i, 0
+        group_tokens += token_count
+    if start < len(token_counts):
+        groups.append((start, len(token_counts)))
+    return groups
+
+
 def to_list(item):
     """Recursively convert collections to Python lists."""
-    if isinstance(item, np.ndarray):
-        # Convert numpy array to list and recursively process each element
-        return [to_list(sub_item) for sub_item in item.tolist()]
-    elif isinstance(item, pd.Series):
-        # Convert pandas Series to list and recursively process each element
+    if isinstance(item, (np.ndarray, pd.Series)):
+        # Numeric arrays become nested lists of scalars with a single tolist() call
+        if item.dtype.kind in 'fiubM':
+            return item.tolist()
+        # Convert to list and recursively process each element
         return [to_list(sub_item) for sub_item in item.tolist()]
     elif isinstance(item, Iterable) and not isinstance(item, (str, bytes, BaseModel, BM)):
         # Recursively process each element in other iterables
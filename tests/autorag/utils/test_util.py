@@ -4,6 +4,7 @@ import os
 import pathlib
 import tempfile
 from datetime import datetime, date
+from typing import List
 
 import numpy as np
 import pandas as pd
@@ -18,7 +19,8 @@ from autorag.utils.util import load_summary_file, result_to_dataframe, \
     make_combinations, explode, replace_value_in_dict, normalize_string, convert_string_to_tuple_in_dict, process_batch, \
     convert_env_in_dict, openai_truncate_by_token, convert_datetime_string, split_dataframe, find_trial_dir, \
     find_node_summary_files, normalize_unicode, dict_to_markdown, dict_to_markdown_table, convert_inputs_to_list, \
-    to_list
+    to_list, flatten_apply, select_top_k, sort_by_scores, reconstruct_list, _pack_by_token_budget, \
+    _aembed_by_token_budget, embedding_query_content
 from tests.mock import MockLLM
 
 root_dir = pathlib.PurePath(os.path.dirname(os.path.realpath(__file__))).parent.parent
@@ -83,6 +85,9 @@ def test_fetch_contents():
     assert find_blank[0] == [None]
     assert find_blank[1] == ['banana']
 
+    with pytest.raises(ValueError):
+        fetch_contents(corpus_data, [['doc4']])
+
 
 def test_load_summary_file(summary_path):
     with pytest.raises(ValueError):
@@ -91,6 +96,25 @@ def test_load_summary_file(summary_path):
     assert df.equals(summary_df)
 
 
+def test_load_summary_file_row_copies():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        summary_path = os.path.join(tmp_dir, "summary.csv")
+        pd.DataFrame({'module_params': [{'top_k': 50}, {'top_k': 50}]}).to_csv(summary_path, index=False)
+        df = load_summary_file(summary_path)
+    df['module_params'].iloc[0]['top_k'] = 10
+    assert df['module_params'].tolist() == [{'top_k': 10}, {'top_k': 50}]
+
+
+def test_load_summary_file_rewritten():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        summary_path = os.path.join(tmp_dir, "summary.csv")
+        pd.DataFrame({'module_params': [{'top_k': 5}]}).to_csv(summary_path, index=False)
+        assert load_summary_file(summary_path)['module_params'].tolist() == [{'top_k': 5}]
+        # rewrite right away, possibly within the same mtime tick
+        pd.DataFrame({'module_params': [{'top_k': 50}, {'top_k': 1}]}).to_csv(summary_path, index=False)
+        assert load_summary_file(summary_path)['module_params'].tolist() == [{'top_k': 50}, {'top_k': 1}]
+
+
 def test_load_summary_file_recency_filter():
     df = pd.DataFrame({
         'module_name': ['havertz', 'recency_filter'],
@@ -172,6 +196,14 @@ def test_make_combinations():
     assert len(combinations) == len(solution)
     assert all([combination in solution for combination in combinations])
 
+    target_dict = {'key1': [3, 1, 3, 2], 'key2': 'value2'}
+    combinations = make_combinations(target_dict)
+    assert combinations == [
+        {'key1': 3, 'key2': 'value2'},
+        {'key1': 1, 'key2': 'value2'},
+        {'key1': 2, 'key2': 'value2'},
+    ]
+
 
 def test_explode():
     index_values = ['a', 'b', 'c']
@@ -185,6 +217,66 @@ def test_explode():
     assert result_values == ['apple', 'banana', 'cherry', 'april', 'may', 'alpha']
 
 
+def test_reconstruct_list():
+    flat_list = [[0.1, 0.2], [0.3, 0.4], [0.5, 0.6], [0.7, 0.8]]
+    result = reconstruct_list(flat_list, [1, 0, 3])
+    assert result == [[[0.1, 0.2]], [], [[0.3, 0.4], [0.5, 0.6], [0.7, 0.8]]]
+
+
+def test_flatten_apply():
+    nested_list = [['apple', 'banana'], ['cherry'], [], ['april', 'may', 'june']]
+    result = flatten_apply(lambda x, suffix: [elem + suffix for elem in x], nested_list, suffix='!')
+    assert result == [['apple!', 'banana!'], ['cherry!'], [], ['april!', 'may!', 'june!']]
+
+
+def test_sort_by_scores():
+    row = {
+        'contents': ['apple', 'banana', 'cherry', 'durian'],
+        'ids': ['id1', 'id2', 'id3', 'id4'],
+        'scores': [0.1, 0.5, 0.5, 0.3],
+    }
+    contents, ids, scores = sort_by_scores(row)
+    assert contents == ['banana', 'cherry', 'durian', 'apple']
+    assert ids == ['id2', 'id3', 'id4', 'id1']
+    assert scores == [0.5, 0.5, 0.3, 0.1]
+
+    contents, ids, scores = sort_by_scores(row, reverse=False)
+    assert contents == ['apple', 'durian', 'banana', 'cherry']
+    assert ids == ['id1', 'id4', 'id2', 'id3']
+    assert scores == [0.1, 0.3, 0.5, 0.5]
+
+    row['scores'] = np.array(row['scores'])
+    contents, ids, scores = sort_by_scores(row)
+    assert contents == ['banana', 'cherry', 'durian', 'apple']
+    assert ids == ['id2', 'id3', 'id4', 'id1']
+    assert scores == [0.5, 0.5, 0.3, 0.1]
+
+    contents, ids, scores = sort_by_scores(row, reverse=False)
+    assert contents == ['apple', 'durian', 'banana', 'cherry']
+    assert ids == ['id1', 'id4', 'id2', 'id3']
+    assert scores == [0.1, 0.3, 0.5, 0.5]
+
+    row = {'contents': ['apple', 'banana'], 'ids': ['id1', 'id2'], 'scores': np.array([0, 5], dtype=np.uint8)}
+    contents, ids, scores = sort_by_scores(row)
+    assert contents == ['banana', 'apple']
+    assert scores == [5, 0]
+
+    row['scores'] = np.array([False, True])
+    contents, ids, scores = sort_by_scores(row)
+    assert contents == ['banana', 'apple']
+    assert scores == [True, False]
+
+
+def test_select_top_k():
+    df = pd.DataFrame({
+        'contents': [['apple', 'banana', 'cherry'], ['april', 'may']],
+        'scores': [[0.9, 0.5, 0.1], [0.8, 0.2]],
+    })
+    result = select_top_k(df, ['contents', 'scores'], 2)
+    assert result['contents'].tolist() == [['apple', 'banana'], ['april', 'may']]
+    assert result['scores'].tolist() == [[0.9, 0.5], [0.8, 0.2]]
+
+
 def test_replace_value_in_dict():
     target_dict = {
         'key1': 'value1',
@@ -323,15 +415,78 @@ def test_openai_truncate_by_token():
     assert len(truncated[2]) == len(t3)
 
 
+class BatchCountingEmbedding(BaseEmbedding):
+    """Embedding shaped like a local Hugging Face embedder: it only batches in the sync API."""
+    batch_calls: List[int] = []
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._get_text_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_text_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return [float(len(text))]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        self.batch_calls.append(len(texts))
+        return [[float(len(text))] for text in texts]
+
+
+def test_embedding_query_content():
+    embedding_model = BatchCountingEmbedding(batch_calls=[])
+    queries = ['a', 'bb']
+    contents_list = [['ccc', 'dddd'], [], ['eeeee', 'f', 'gg']]
+    query_embeddings, content_embeddings = embedding_query_content(queries, contents_list, embedding_model, batch=64)
+    assert query_embeddings == [[1.0], [2.0]]
+    assert content_embeddings == [[[3.0], [4.0]], [], [[5.0], [1.0], [2.0]]]
+    # queries and contents are embedded together in a single batch
+    assert embedding_model.batch_calls == [7]
+
+
+def test_pack_by_token_budget():
+    # token budget split
+    assert _pack_by_token_budget([100, 150, 50, 200, 100], 300, 10) == [(0, 3), (3, 5)]
+    # max_items split
+    assert _pack_by_token_budget([1] * 7, 300, 3) == [(0, 3), (3, 6), (6, 7)]
+    # a single text over budget gets its own group
+    assert _pack_by_token_budget([100, 500, 100], 300, 10) == [(0, 1), (1, 2), (2, 3)]
+    assert _pack_by_token_budget([], 300, 10) == []
+
+
+def test_aembed_by_token_budget(monkeypatch):
+    class StubEmbedding:
+        def __init__(self):
+            self.requests = []
+
+        async def aget_text_embedding_batch(self, texts):
+            self.requests.append(list(texts))
+            # finish later groups first to check that the output order does not depend on completion order
+            await asyncio.sleep(0.01 / len(self.requests))
+            return [[float(len(text))] for text in texts]
+
+    monkeypatch.setattr('autorag.utils.util._OPENAI_MAX_TOKENS_PER_REQUEST', 5)
+    embedding_model = StubEmbedding()
+    texts = ['a', 'bb', 'ccc', 'dddd', 'e']
+
+    async def embed():
+        return await _aembed_by_token_budget(embedding_model, texts, list(map(len, texts)), 2, asyncio.Semaphore(8))
+
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(embed())
+    assert result == [[1.0], [2.0], [3.0], [4.0], [1.0]]
+    assert embedding_model.requests == [['a', 'bb'], ['ccc'], ['dddd', 'e']]
+
+
 def test_split_dataframe():
     df = pd.DataFrame({'a': list(range(10)), 'b': list(range(10, 20))})
 
-    df_list_1 = split_dataframe(df, chunk_size=5)
+    df_list_1 = list(split_dataframe(df, chunk_size=5))
     assert len(df_list_1) == 2
     assert len(df_list_1[0]) == 5
     assert pd.DataFrame({'a': list(range(5)), 'b': list(range(10, 15))}).equals(df_list_1[0])
 
-    df_list_2 = split_dataframe(df, chunk_size=3)
+    df_list_2 = list(split_dataframe(df, chunk_size=3))
     assert len(df_list_2) == 4
     assert len(df_list_2[0]) == 3
     assert len(df_list_2[-1]) == 1
@@ -354,6 +509,25 @@ def test_find_node_summary_files():
     assert all(os.path.basename(path) == 'summary.csv' for path in node_summary_paths)
 
 
+def test_find_node_summary_files_depth_and_hidden():
+    with tempfile.TemporaryDirectory() as trial_dir:
+        expected = []
+        for dir_parts, is_expected in [((), False), (('node_line',), False), (('node_line', 'node'), True),
+                                       (('node_line', 'node', 'sub'), True), (('.hidden', 'node'), False),
+                                       (('node_line', '.hidden'), False)]:
+            dir_path = os.path.join(trial_dir, *dir_parts)
+            os.makedirs(dir_path, exist_ok=True)
+            summary_path = os.path.join(dir_path, 'summary.csv')
+            pathlib.Path(summary_path).touch()
+            if is_expected:
+                expected.append(summary_path)
+        assert sorted(find_node_summary_files(trial_dir)) == sorted(expected)
+
+        missing_dir = os.path.join(trial_dir, 'missing')
+        assert find_node_summary_files(missing_dir) == []
+        assert find_trial_dir(missing_dir) == []
+
+
 def test_normalize_unicode():
     str1 = "전국보행자전용도로표준데이터"
     str2 = "전국보행자전용도로표준데이터"
@@ -431,3 +605,10 @@ def test_to_list():
     embedding_model = OpenAIEmbedding()
     new_model = to_list(embedding_model)
     assert isinstance(new_model, BaseEmbedding)
+
+    embeddings = to_list(np.array([[0.1, 0.2], [0.3, 0.4]]))
+    assert embeddings == [[0.1, 0.2], [0.3, 0.4]]
+    assert all(isinstance(elem, float) for row in embeddings for elem in row)
+
+    nested = to_list(pd.Series([np.array(['a', 'b'], dtype=object), np.array([1, 2])]))
+    assert nested == [['a', 'b'], [1, 2]]